@@ -1,5 +1,4 @@
 import torch
-from einops import rearrange
 import torch.nn as nn
 import torch.nn.functional as F
 from transformers import T5EncoderModel
@@ -8,6 +7,14 @@ from transformers import T5EncoderModel
 The components for the transformer model
 """
 
+# inductor options used whenever a part of the model gets compiled
+INDUCTOR_CONFIGS = {
+    'epilogue_fusion': True,
+    'coordinate_descent_tuning': True,
+    'max_autotune': True,
+    'triton.cudagraphs': True,
+}
+
 class EncoderBlock(nn.Module):
     """
     Params:
@@ -35,20 +42,22 @@ class MultiAxisTransformerBlock(nn.Module):
     """
     Params:
         nchannels: the hidden size of the image input
+        img_size: the height and width of the image input
         block_size: the kernel size of the image blocks
         nhead: number of heads
         dropout: dropout rate
+        n_tile: number of blocks attended at a time, see MultiAxisAttention
     Args:
        input: the image input (b, c, h, w)
        context: the image input (b, h * w, c) 
     Returns:
         y: the final hidden state (b, n, p, c)
     """
-    def __init__(self, nchannels:int, block_size:int, nhead:int, dropout:float) -> None:
-        super(MultiAxisTransformerBlock, self).__init()
+    def __init__(self, nchannels:int, img_size:int, block_size:int, nhead:int, dropout:float, n_tile:int=None) -> None:
+        super(MultiAxisTransformerBlock, self).__init__()
 
         self.ln1 = nn.LayerNorm(nchannels)
-        self.self_attn = MultiAxisAttention(nchannels, block_size, nhead, dropout)
+        self.self_attn = MultiAxisAttention(nchannels, img_size, block_size, nhead, dropout, n_tile)
         self.ln2 = nn.LayerNorm(nchannels)
         self.cross_attn = MultiQueryAttention(nchannels, nhead, dropout)
         self.mlp = MLP(nchannels)
@@ -101,18 +110,39 @@ class MLP(nn.Module):
         # inner dimension - per Shazeer's recommendation on GEGLU
         inner_dim = int(emb_dim * 4 * 2/3)
         # all other components of the MLP
-        self.ln1 = nn.LayerNorm(emb_dim)
-        self.proj1 = nn.Linear(emb_dim, inner_dim, bias=False)
+        # GEGLU halves the hidden size, so project to twice the inner dimension
+        self.proj1 = FusedNormLinear(emb_dim, 2 * inner_dim)
         self.act = GEGLU()
-        self.ln2 = nn.LayerNorm(inner_dim)
-        self.proj2 = nn.Linear(inner_dim, emb_dim, bias=False)
+        self.proj2 = FusedNormLinear(inner_dim, emb_dim)
 
     def forward(self, x):
-        x = self.proj1(self.ln1(x))
+        x = self.proj1(x)
         x = self.act(x)
-        x = self.proj2(self.ln2(x))
+        x = self.proj2(x)
         return x
 
+class FusedNormLinear(nn.Module):
+    """
+    Params:
+        in_dim: dimension size of the input
+        out_dim: dimension size of the output
+    Args:
+        x: the input embeddings (b, ..., in_dim)
+    Returns:
+        x: the normalized and projected embeddings (b, ..., out_dim)
+    """
+    def __init__(self, in_dim:int, out_dim:int) -> None:
+        super(FusedNormLinear, self).__init__()
+
+        # a fixed eps, the default depends on the input dtype and so on autocast
+        self.norm = nn.RMSNorm(in_dim, eps=1e-5)
+        self.proj = nn.Linear(in_dim, out_dim, bias=False)
+
+    def forward(self, x):
+        # nothing is fused in eager mode - only under compile_blocks / compile_mlp does inductor
+        # fuse the norm's pointwise work with its neighbours and cut the round trips through memory
+        return self.proj(self.norm(x))
+
 class MultiQueryAttention(nn.Module):
     """
     Params:
@@ -134,127 +164,186 @@ class MultiQueryAttention(nn.Module):
         self.scale = (emb_dim // nhead) ** -0.5
 
         # projection layers
-        self.to_q = nn.Linear(emb_dim, emb_dim, bias=False)
-        self.to_kv = nn.Linear(emb_dim, 2 * emb_dim // nhead, bias=False)
+        # the query and the single key/value head share one matmul for self-attention
+        self.to_qkv = nn.Linear(emb_dim, emb_dim + 2 * (emb_dim // nhead), bias=False)
         self.to_o = nn.Linear(emb_dim, emb_dim, bias=False)
 
-        # regularization
+        # regularization - a plain float so that compiled graphs treat it as a constant
         self.dropout = dropout
-        self.attn_dropout = nn.Dropout(dropout)
-
-        # check if the flash attention is available - this will make computation fast
-        self.flash = hasattr(F, 'scaled_dot_product_attnetion')
 
     def forward(self, input, context=None):
         h = self.nhead
-        context = context if not None else input
-
-        q, k, v = (self.to_q(input), *self.to_kv(context).chunk(2, dim=-1))
-        q = rearrange(q, "b ... (h d) -> b h ... d", h=h) * self.scale
-
-        if self.flash:
-            y = F.scaled_dot_product_attention(q, k, v, dropout_p=self.dropout if self.training else 0.0, is_causal=False)
-        
+        d = self.emb_dim
+        # every query attends on its own, so flatten any leading dims into one (b, n, d) sequence
+        lead = input.shape[:-1]
+        input = input.reshape(lead[0], -1, d)
+        b, n, d_h = *input.shape[:2], d // h
+
+        if context is None:
+            q, k, v = self.to_qkv(input).split([d, d // h, d // h], dim=-1)
         else:
-            sim = torch.einsum("b ... n d, b t d -> b ... n t", q, k)
-            att = self.attn_dropoutdropout(sim.softmax(dim=-1))
-            y = torch.einsum("b ... n t, b t d -> b ... n d", att, v)
-
-        y = rearrange(y, "b h ... d -> b ... (h d)")
-
-        return self.to_o(y)
+            # cross-attention projects the input and the context with their own slices of the weight
+            # the context is flattened into one (b, t, d) sequence like the input
+            context = context.reshape(context.shape[0], -1, d)
+            w_q, w_kv = self.to_qkv.weight.split([d, 2 * (d // h)])
+            q, k, v = (F.linear(input, w_q), *F.linear(context, w_kv).chunk(2, dim=-1))
+        q = q.view(b, n, h, d_h).transpose(1, 2)
+        # the single key/value head (b, 1, t, d_h) is shared by all the query heads
+        # inside the kernel, so it is never copied once per head
+        k, v = k.unsqueeze(1), v.unsqueeze(1)
+
+        # flash attention for really fast computation - the kernel applies the scale itself
+        # enable_gqa needs torch >= 2.5. only the flash kernel broadcasts k/v on its own, so fp32
+        # inputs outside of the bf16 autocast region fall back to the math kernel
+        y = F.scaled_dot_product_attention(
+            q, k, v, dropout_p=self.dropout * self.training, is_causal=False, scale=self.scale, enable_gqa=True
+        )
+
+        # the fused kernels already write y as (b, n, h, d_h), so merging the heads is free
+        y = y.transpose(1, 2).reshape(b, n, d)
+
+        return self.to_o(y).reshape(*lead, d)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved before to_q and to_kv were fused into to_qkv
+        if prefix + 'to_q.weight' in state_dict:
+            state_dict[prefix + 'to_qkv.weight'] = torch.concat(
+                (state_dict.pop(prefix + 'to_q.weight'), state_dict.pop(prefix + 'to_kv.weight'))
+            )
+        super(MultiQueryAttention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
     
 class MultiAxisAttention(nn.Module):
     """
     Params:
         nchannels: the hidden size of the image input
+        img_size: the height and width of the image input
         block_size: the kernel size of the image blocks
         nhead: number of heads
         dropout: dropout rate
+        n_tile: number of blocks attended at a time, all of them by default. a tile of q holds
+            b * n_tile * (nhead / 2) * block_size ** 2 * (nchannels / nhead) elements, so pick it to fit
+            in the L2 cache. with a batch above one, tiles smaller than all the blocks copy q, k and v
     Args:
        img: the image input (b, c, h, w) 
     Returns:
         y: the final hidden state (b, n, p, c)
     """
-    def __init__(self, nchannels:int, block_size:int, nhead:int, dropout:float) -> None:
+    def __init__(self, nchannels:int, img_size:int, block_size:int, nhead:int, dropout:float, n_tile:int=None) -> None:
         super(MultiAxisAttention, self).__init__()
 
-        # create the blocker
-        self.blocker = nn.Unfold(block_size, stride=block_size)
-        
+        # assert that images can be square rooted by the block sizes
+        assert img_size % block_size == 0 and img_size // block_size == block_size
+
+        # the geometry is fixed for the whole run, so cache it as plain ints - compiled
+        # graphs bake these in as constants instead of computing them from the input shape
         self.nhead = nhead
         self.nchannels = nchannels
+        self.img_size = img_size
         self.block_size = block_size
+        self.grid_size = img_size // block_size
+        self.n_blocks = self.grid_size ** 2
+        self.block_len = block_size ** 2
+        self.n_tile = n_tile if n_tile is not None else self.n_blocks
         self.scale = (nchannels // nhead) ** -0.5
 
         # projection layers
         self.to_qkv = nn.Linear(nchannels, 3 * nchannels, bias=False)
         self.to_o = nn.Linear(nchannels, nchannels, bias=False)
 
-        # check if the flash attention is available
-        self.flash = hasattr(F, 'scaled_dot_product_attnetion')
-
-        # regularization based on flash attention
-        if self.flash:
-            self.dropout = dropout
-        else:
-            self.attn_dropout = nn.Dropout(dropout)
+        # regularization - a plain float so that compiled graphs treat it as a constant
+        self.dropout = dropout
 
     def forward(self, img):
-        # assert that images are square and can be square rooted by the block sizes
-        assert img.shape[2] == img.shape[3]
-        assert img.shape[2] // self.block_size == self.block_size
-        # cache the head and channel information
-        h = self.nhead
-        c = self.nchannels
-
-        # chop the image into blocks
-        img_blocks = self.blocker(img)
-        img_blocks = map(lambda t: rearrange(t, "b (c k k) n -> b n (k k) c", c=c), (img_blocks))
-
-        # project the image into query and key values
-        q, k, v = self.to_qkv(img_blocks).chunk(3, dim=-1)
-        q, k, v = map(lambda t: rearrange(t, 'b n p (h c) -> b h n p c', h = h) * self.scale, (q, k, v))
-
-        # split and transpose
-        # this will let us perform dilated and regional self attention 
-        q, k, v = axis_splitting(q, k, v, h)
-
-        # flash attention for really fast computation
-        if self.flash:
-            y = F.scaled_dot_product_attention(
-                q, k, v, dropout_p = self.dropout if self.training else 0.0, is_causal=False
-            )
-        # slower operation using einsum
-        else:
-            sim = torch.einsum("b h n p c, b h n q c -> b h n p q", q, k)
-            att = F.dropout(sim.softmax(dim=-1))
-            y = torch.einsum("b h n p q, b h n q c -> b h n p c", att, v)
-
-        y = rearrange(y, "b h n p c -> b n p (h c)")
-
-        return y
+        # assert that the image has the geometry fixed at construction
+        # with static shapes this is only checked when the graph is traced
+        assert img.shape[2:] == (self.img_size, self.img_size)
+        # cache the head, channel and block information
+        b, h, c = img.shape[0], self.nhead, self.nchannels
+        g, blk, n, p = self.grid_size, self.block_size, self.n_blocks, self.block_len
+
+        # chop the image into non-overlapping blocks (b, n, p, c)
+        # the blocks do not overlap, so this is a view followed by a single copy
+        img_blocks = img.view(b, c, g, blk, g, blk).permute(0, 2, 4, 3, 5, 1).reshape(b, n, p, c)
+
+        # project the image into the query, key and value heads (b, n, p, 3, h, c)
+        qkv = self.to_qkv(img_blocks).view(b, n, p, 3, h, c // h)
+
+        # the first half of the heads attends across the blocks (dilated) and the other half within
+        # them (regional). each half is attended on its own, straight into its heads of the output,
+        # which is kept in the (b, n, p, h, c) layout read by the output projection
+        dropout_p = self.dropout * self.training
+        y = qkv.new_empty(b, n, p, h, c // h)
+        # dilated attention - swap the axes so the position within the block indexes the problems
+        tiled_block_attention(
+            qkv[..., :h // 2, :].transpose(1, 2), y[..., :h // 2, :].transpose(1, 2), dropout_p, self.scale, self.n_tile
+        )
+        # regional attention
+        tiled_block_attention(qkv[..., h // 2:, :], y[..., h // 2:, :], dropout_p, self.scale, self.n_tile)
+
+        return self.to_o(y.view(b, n, p, c))
 
 # helper functions
-def axis_splitting(q, k, v, h):
-    # channel splitting
-    q1, k1, v1 = (q[:, :h // 2, ...], k[:, :h // 2, ...], v[:, :h // 2, ...])
-    q2, k2, v2 = (q[:, h // 2:, ...], k[:, h // 2:, ...], v[:, h // 2:, ...])
-    
-    # transpose and concat
-    q1, k1, v1 = map(lambda t: torch.transpose(t, 2, 3), (q1, k1, v1))
-    q, k , v = map(lambda ts: torch.concat(ts, dim=1), ((q1, q2), (k1, k2), (v1, v2)))
+def block_attention(q, k, v, dropout_p, scale):
+    # q, k, v (b, m, s, h, d) where m indexes independent attention problems over s tokens
+    # the fused kernels only take 4d inputs, so fold m into the batch and put the heads ahead of
+    # the tokens - this is their native layout, so nothing is copied when b and m can be merged
+    b = q.shape[0]
+    q, k, v = map(lambda t: t.flatten(0, 1).transpose(1, 2), (q, k, v))
+    # flash attention for really fast computation
+    y = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p, is_causal=False, scale=scale)
+    return y.transpose(1, 2).unflatten(0, (b, -1))
+
+def tiled_block_attention(qkv, out, dropout_p, scale, n_tile):
+    # qkv (b, m, s, 3, h, d) and out (b, m, s, h, d) - the m axis only indexes independent
+    # attention problems, so attend it a tile at a time and write every tile directly into the output.
+    # unless the tile covers the whole axis (or b is one), b and m cannot be merged and the tile is copied
+    for i in range(0, qkv.shape[1], n_tile):
+        tile = slice(i, i + n_tile)
+        out[:, tile] = block_attention(*qkv[:, tile].unbind(3), dropout_p, scale)
+    return out
+
+def enable_tf32():
+    # let the fp32 matmuls that remain outside of autocast run on tf32 tensor cores
+    # this changes the matmul precision of the whole process, so call it from the entry point
+    torch.set_float32_matmul_precision('high')
+
+def compile_blocks(model, mode:str=None):
+    # compile every transformer block in place so that the norms, residual adds and
+    # activations get fused with the matmuls. shapes must stay fixed to hit the cuda graphs.
+    # by default the blocks use INDUCTOR_CONFIGS (max-autotune + cuda graphs), mode="reduce-overhead"
+    # only records the cuda graphs and skips the autotuning.
+    # the blocks are compiled in place, so forward, forward_with_cond_scale and forward_with_neg_prompt
+    # all replay them - a TransformerBlock gets one graph with and one without the text context.
+    # the text encoder and the token masking stay eager. the first calls of every graph only warm up
+    # and record it, and training loops should call torch.compiler.cudagraph_mark_step_begin() per step
+    kwargs = dict(options=INDUCTOR_CONFIGS) if mode is None else dict(mode=mode)
+    for module in model.modules():
+        if isinstance(module, (EncoderBlock, TransformerBlock, MultiAxisTransformerBlock)):
+            module.compile(fullgraph=True, dynamic=False, **kwargs)
+    return model
 
-    return q, k, v
+def compile_mlp(model):
+    # compile only the MLPs in place, so the whole norm -> matmul -> GEGLU -> norm -> matmul chain
+    # is one graph. not needed after compile_blocks, which already traces the MLPs of every block
+    for module in model.modules():
+        if isinstance(module, MLP):
+            module.compile(fullgraph=True, dynamic=False, options=INDUCTOR_CONFIGS)
+    return model
 
 def get_text_encoder(t5_model):
     model = T5EncoderModel.from_pretrained(t5_model)
     # Freeze the weights
     for param in model.parameters():
         param.requires_grad = False
-    return model
+    # the encoder only provides the conditioning context, so keep it in eval mode and bf16
+    # callers should run it under torch.no_grad() - not inference_mode(), as its output
+    # is saved for backward by the trainable text projection
+    model.eval()
+    return model.to(dtype=torch.bfloat16)
 
 class GEGLU(nn.Module):
     def forward(self, x):
-        x, gate = x.chunk(2, dim=-1)
-        return gate * F.gelu(x, 'tanh')
\ No newline at end of file
+        # plain slices are views, so the split, gelu and gating fuse into one pointwise kernel
+        d = x.shape[-1] // 2
+        x, gate = x[..., :d], x[..., d:]
+        return gate * F.gelu(x, approximate='tanh')
\ No newline at end of file
@@ -9,6 +9,8 @@ Transformer components for the MUSE model
 class SuperResTransformer(nn.Module):
     def __init__(self, config) -> None:
         super(SuperResTransformer, self).__init__()
+        # the multi-axis attention only supports square target images
+        assert config.tgt_height == config.tgt_width
 
         self.src_seq_len = config.src_height * config.src_width
         self.tgt_seq_len = config.tgt_height * config.tgt_height
@@ -22,7 +24,7 @@ class SuperResTransformer(nn.Module):
                 [EncoderBlock(config.emb_dim, config.nhead, config.dropout) for _ in range(config.n_enc_layer)]
             ),
             decoder = nn.ModuleList(
-                [MultiAxisTransformerBlock(config.emb_dim, config.block_size, config.nhead, config.dropout) for _ in range(config.n_dec_layer)],
+                [MultiAxisTransformerBlock(config.emb_dim, config.tgt_height, config.block_size, config.nhead, config.dropout) for _ in range(config.n_dec_layer)],
             ),
             ln_f = nn.LayerNorm(config.emb_dim)
         ))
@@ -33,23 +35,32 @@ class SuperResTransformer(nn.Module):
         self.text_encoder = get_text_encoder(config.t5_model)
         self.proj_text = nn.Linear(config.text_emb_dim, config.emb_dim)
 
+    def train(self, mode:bool=True):
+        super(SuperResTransformer, self).train(mode)
+        # the frozen text encoder always stays in eval mode
+        self.text_encoder.eval()
+        return self
+
     def forward(self, low_res, hi_res, text):
         n, m, device = self.src_seq_len, self.tgt_seq_len, low_res.device
         # encode and project the text into our model's dimension
-        text_emb = self.text_encoder(text)
-        text_emb = self.proj_text(text_emb.last_hidden_states)
+        with torch.no_grad():
+            text_emb = self.text_encoder(text)
+        text_emb = self.proj_text(text_emb.last_hidden_state.type_as(self.proj_text.weight))
         # embed the image and inject positional information
         src_emb = self.transformer.src_embedding(low_res)
         src_emb = self.dropout(src_emb + self.transformer.src_pos_enc2d(torch.arange(n, device=device)))
-        # pass the source embedding to encoders
-        src_emb = self.transformer.encoder(src_emb)
-        # concat the low-res images with the text embedding
-        src_emb = torch.cat(src_emb, text_emb, dim=-1)
         # embed the hi-res tokens
         tgt_emb = self.transformer.tgt_embedding(hi_res)
         tgt_emb = self.dropout(tgt_emb + self.transformer.tgt_pos_enc2d(torch.arange(m, device=device)))
-        # pass the target embedding to the transformers
-        tgt_emb = self.transformer.decoder(tgt_emb, src_emb)
+        # run the transformer blocks in bf16, the final norm and head stay in fp32
+        with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=device.type == 'cuda'):
+            # pass the source embedding to encoders
+            src_emb = self.transformer.encoder(src_emb)
+            # concat the low-res images with the text embedding
+            src_emb = torch.cat(src_emb, text_emb, dim=-1)
+            # pass the target embedding to the transformers
+            tgt_emb = self.transformer.decoder(tgt_emb, src_emb)
         tgt_emb = self.transformer.ln_f(tgt_emb)
 
         return self.lm_head(tgt_emb)
@@ -77,6 +88,12 @@ class BaseTransformer(nn.Module):
         self.text_encoder = get_text_encoder(config.t5_model)
         self.proj_text = nn.Linear(config.text_emb_dim, config.emb_dim)
 
+    def train(self, mode:bool=True):
+        super(BaseTransformer, self).train(mode)
+        # the frozen text encoder always stays in eval mode
+        self.text_encoder.eval()
+        return self
+
     def get_mask(self):
         p = 2/pi * (1 - random.random() ** 2) ** (-1/2)
         mask = (torch.randn(self.seq_len) < p)
@@ -88,8 +105,9 @@ class BaseTransformer(nn.Module):
         # encode and project the text into our model's dimension
         # only do this 90% of the time
         if text is not None:
-            text_emb = self.text_encoder(text)
-            text_emb = self.proj_text(text_emb.last_hidden_states)
+            with torch.no_grad():
+                text_emb = self.text_encoder(text)
+            text_emb = self.proj_text(text_emb.last_hidden_state.type_as(self.proj_text.weight))
         else:
             text_emb = text
 
@@ -99,7 +117,9 @@ class BaseTransformer(nn.Module):
         img_emb = self.transformer.img_embedding(img.flatten(dim=1).masked_fill(self.get_mask(), mask_id))
         img_emb = self.dropout(img_emb + self.transformer.pos_enc2d(torch.arange(n, device=device)))
         # pass the image embedding through the transformer block
-        img_emb = self.transformer.decoder(img_emb, text_emb)
+        # run the transformer blocks in bf16, the final norm and head stay in fp32
+        with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=device.type == 'cuda'):
+            img_emb = self.transformer.decoder(img_emb, text_emb)
         img_emb = self.transformer.ln_f(img_emb)
 
         return self.lm_head(img_emb)